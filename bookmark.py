@@ -13,7 +13,12 @@ def main() -> int:
     """Create bookmarks.html from a list of URLs."""
 
     try:
-        Utils("config.yml").write_bookmarks()
+        utils = Utils("config.yml")
+
+        try:
+            utils.write_bookmarks()
+        finally:
+            utils.close()
     except Exception as ex:
         logger.error("Error:", exc_info=True)
 
@@ -1,87 +1,159 @@
 """Utility class for creating bookmarks.html from a list of URLs."""
 
-import base64
+import binascii
+import functools
+import html
 import logging
 import mimetypes
+import operator
+import posixpath
 import random
+import re
+import sqlite3
+import threading
 import time
+import urllib.parse
+
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import requests
 import yaml
 
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from lxml.etree import ParserError
+from lxml.html import HtmlElement, document_fromstring
 
-from dominate import document
-from dominate.util import raw
-from dominate.tags import a, dt, dl, p, h1, html_tag, meta
+try:
+    # libyaml-backed loader when PyYAML was built with it
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 
 logger = logging.getLogger(__name__)
 
 current_time_seconds = int(time.time())
 
+# every entry carries the same timestamps, so format them once
+DATE_ATTRIBUTES = (
+    f' ADD_DATE="{current_time_seconds}" LAST_MODIFIED="{current_time_seconds}"'
+)
+
 BOOKMARKS_KEY = "bookmarks"
 FOLDERS_KEY = "folders"
 
+TITLE_RE = re.compile(rb"<title[^>]*>(.*?)</title", re.IGNORECASE | re.DOTALL)
+TITLE_END_RE = re.compile(rb"</title", re.IGNORECASE)
+HEAD_END_RE = re.compile(rb"</head", re.IGNORECASE)
+
+# <meta charset> is required to appear early in the document
+META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset=["']?([\w.:-]+)""", re.IGNORECASE)
+META_CHARSET_BYTES = 2048
+
+XML_DECLARATION_RE = re.compile(r"^\ufeff?\s*<\?xml[^>]*\?>")
+
+CHUNK_SIZE = 8192
+
+# cached favicon for pages that were checked and had no usable icon; None means
+# the row was cached while favicons were disabled
+NO_FAVICON = ""
+
+INDENT = "    "
 
-class H3(html_tag):
-    """Address bug in Chromium where <h3> tag has to render in uppercase to import properly."""
+# RFC 3986 reserved and unreserved punctuation, plus "%" for existing escapes
+URI_SAFE = ":/?#[]@!$&'()*+,;=%~-._"
 
 
+@functools.total_ordering
 class BookmarkInfo:
     """Information about a bookmark."""
 
-    url = None
-    title = None
-    content = None
-    favicon = None
-    folders = None
+    # one instance per bookmark; slots drop the per-instance __dict__
+    __slots__ = (
+        "url",
+        "title",
+        "content",
+        "favicon",
+        "folders",
+        "response_url",
+        "encoding",
+        "etag",
+        "last_modified",
+        "modified",
+        "_html",
+    )
 
     def __init__(self, url: str, content: str):
         self.url = url
+        self.title = None
         self.content = content
+        self.favicon = None
+        self.folders = None
+        self.response_url = None
+        self.encoding = None
+        self.etag = None
+        self.last_modified = None
+        self.modified = True
+        self._html = None
 
     def __str__(self):
         return f"url = {self.url}; title = {self.title}"
 
     def __lt__(self, other):
-        return self.folders < other.folders and self.url < other.url
-
-    def __le__(self, other):
-        return self.folders <= other.folders and self.url <= other.url
+        return (self.folders, self.url) < (other.folders, other.url)
 
     def __eq__(self, other):
-        return self.folders == other.folders and self.url == other.url
+        return (self.folders, self.url) == (other.folders, other.url)
 
-    def __ne__(self, other):
-        return self.folders != other.folders and self.url != other.url
+    @staticmethod
+    def _ascii_url(url: str) -> str:
+        """Convert a URL with non-ASCII characters to an ASCII URI."""
 
-    def __gt__(self, other):
-        return self.folders > other.folders and self.url > other.url
+        # nearly every URL is already ASCII
+        if url.isascii():
+            return url
 
-    def __ge__(self, other):
-        return self.folders >= other.folders and self.url >= other.url
+        parts = urllib.parse.urlsplit(url)
 
-    def html(self):
-        """Return HTML representation of bookmark."""
+        netloc = parts.netloc
 
-        _dt = dt()
+        if not netloc.isascii():
+            user_info, at, host_port = netloc.rpartition("@")
+            host, colon, port = host_port.partition(":")
 
-        # BUG in Chromium: <a> tag has to render all on one line to import properly
-        _a = a(
-            self.title,
-            href=self.url,
-            ADD_DATE=current_time_seconds,
-            LAST_MODIFIED=current_time_seconds,
-            __pretty=False,
-        )
+            try:
+                host = host.encode("idna").decode("ascii")
+            except UnicodeError:
+                logger.debug("Cannot IDNA-encode host '%s'", host)
 
-        if self.favicon is not None:
-            _a["icon"] = self.favicon
+            netloc = f"{user_info}{at}{host}{colon}{port}"
 
-        _dt.add(_a)
+        return urllib.parse.quote(parts._replace(netloc=netloc).geturl(), safe=URI_SAFE)
 
-        return _dt
+    def html(self) -> str:
+        """Return HTML representation of bookmark.
+
+        The line is escaped and formatted on the first call and reused after
+        that, so url, title and favicon must be final before rendering.
+        """
+
+        if self._html is None:
+            icon = ""
+
+            if self.favicon is not None:
+                icon = f' ICON="{html.escape(self.favicon)}"'
+
+            # BUG in Chromium: <A> tag has to render all on one line to import properly
+            self._html = (
+                f'<DT><A HREF="{html.escape(self._ascii_url(self.url))}"'
+                f"{DATE_ATTRIBUTES}{icon}>"
+                f"{html.escape(self.title)}</A>"
+            )
+
+        return self._html
 
 
 class Config:
@@ -91,37 +163,143 @@ class Config:
 
     def __init__(self, file):
         with open(file, "r", encoding="utf-8") as f:
-            self._values = yaml.safe_load(f)
-
-            f.close()
+            self._values = yaml.load(f, Loader=SafeLoader)
 
     def get(self, key: str, default: any = "") -> any:
         """Get configuration value for key."""
 
-        value = None
+        value = self._values.get(key) if self._values is not None else None
+
+        return default if value is None else value
+
+
+class BookmarkCache:
+    """Persist retrieved bookmark information between runs."""
+
+    _connection = None
+    _lock = None
+
+    def __init__(self, file: str):
+        self._lock = threading.Lock()
+
+        # rows are read and written from worker threads, serialized by _lock
+        self._connection = sqlite3.connect(file, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+
+        with self._connection:
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS meta (
+                    url TEXT PRIMARY KEY,
+                    resolved_url TEXT,
+                    etag TEXT,
+                    last_modified TEXT,
+                    title TEXT,
+                    favicon TEXT,
+                    fetched REAL
+                )"""
+            )
+
+    def get(self, url: str) -> sqlite3.Row:
+        """Get cached information for URL, or None if not cached."""
+
+        with self._lock:
+            return self._connection.execute(
+                "SELECT * FROM meta WHERE url = ?", (url,)
+            ).fetchone()
+
+    def put(self, url: str, bookmark_info: BookmarkInfo, favicon_checked: bool):
+        """Cache information retrieved for URL."""
+
+        favicon = bookmark_info.favicon
+
+        if favicon is None and favicon_checked:
+            favicon = NO_FAVICON
+
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    bookmark_info.url,
+                    bookmark_info.etag,
+                    bookmark_info.last_modified,
+                    bookmark_info.title,
+                    favicon,
+                    time.time(),
+                ),
+            )
+
+    def close(self):
+        """Commit cached rows and close the database."""
 
-        if self._values is not None:
-            value = self._values[key]
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
 
-        if value is None:
-            value = default
 
-        return value
+class HostRateLimiter:
+    """Space out requests to the same host while other hosts proceed."""
+
+    _delay = 0.0
+    _randomize = True
+    _lock = None
+    _next_request = None
+
+    def __init__(self, delay: float, randomize: bool):
+        self._delay = delay
+        self._randomize = randomize
+        self._lock = threading.Lock()
+        self._next_request = {}
+
+    def wait(self, url: str):
+        """Block until a request to the host of URL is allowed."""
+
+        if self._delay <= 0:
+            return
+
+        host = urllib.parse.urlsplit(url).netloc
+
+        if self._randomize:
+            delay = self._delay * random.random()
+        else:
+            delay = self._delay
+
+        # reserve the host's next slot; sleeping happens outside the lock
+        with self._lock:
+            now = time.monotonic()
+
+            start = max(now, self._next_request.get(host, now))
+
+            self._next_request[host] = start + delay
+
+        if start > now:
+            time.sleep(start - now)
 
 
 class Utils:
     """Utility methods for creating bookmarks HTML."""
 
     _config = None
-
-    _sleep_duration = 0
-    random_sleep = True
+    _session = None
+    _cache = None
+    _pages = None
+    _pages_lock = None
+    _favicons = None
+    _favicons_lock = None
+
+    _rate_limiter = None
     default_headers = None
     request_timeout = 60
     rewrite_url = True
     read_favicon = False
+    max_workers = 8
+    cache_ttl = 86400
+    max_bytes = 65536
     folder_separator = None
     subfolder_separator = None
+    urls_file = None
+    bookmarks_html_file = None
+    sort_bookmarks = True
 
     def __init__(self, config_file):
         self._config = Config(config_file)
@@ -135,14 +313,22 @@ class Utils:
 
         logger.debug("config = %s", self._config)
 
+        self.urls_file = self._config.get("urls_file", "urls.txt")
+        self.bookmarks_html_file = self._config.get(
+            "bookmarks_html_file", "bookmarks.html"
+        )
+
         self.folder_separator = self._config.get("folder_separator", "|")
         self.subfolder_separator = self._config.get("subfolder_separator", ",")
 
-        self._sleep_duration = int(self._config.get("sleep", 0))
-        self.random_sleep = bool(self._config.get("random_sleep", True))
+        self._rate_limiter = HostRateLimiter(
+            int(self._config.get("sleep", 0)) / 1000,
+            bool(self._config.get("random_sleep", True)),
+        )
 
         self.default_headers = {
-            header["name"]: header["value"] for header in self._config.get("headers")
+            header["name"]: header["value"]
+            for header in self._config.get("headers", [])
         }
 
         self.request_timeout = int(self._config.get("timeout", 60))
@@ -151,22 +337,113 @@ class Utils:
 
         self.read_favicon = bool(self._config.get("favicon", False))
 
+        self.sort_bookmarks = bool(self._config.get("sort", True))
+
+        self.max_bytes = int(self._config.get("max_bytes", 65536))
+
+        self.max_workers = int(self._config.get("max_workers", 8))
+
+        self._session = self._create_session()
+
+        # futures of page info keyed by URL; a URL may be filed in several folders
+        self._pages = {}
+        self._pages_lock = threading.Lock()
+
+        # futures of favicon data URIs keyed by URL and MIME type; pages share icons
+        self._favicons = {}
+        self._favicons_lock = threading.Lock()
+
+        cache_file = self._config.get("cache_file", "bookmarks.cache")
+
+        if cache_file:
+            self._cache = BookmarkCache(cache_file)
+
+        self.cache_ttl = int(self._config.get("cache_ttl", 86400))
+
+    def _create_session(self) -> requests.Session:
+        """Create a session whose connection pool is shared by all requests."""
+
+        session = requests.Session()
+
+        session.headers.update(self.default_headers)
+
+        # one pooled connection per worker so keep-alive sockets are reused
+        adapter = HTTPAdapter(
+            pool_connections=self.max_workers,
+            pool_maxsize=self.max_workers,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.2,
+                status_forcelist=(429, 500, 502, 503, 504),
+            ),
+        )
+
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        return session
+
+    def close(self):
+        """Release pooled connections."""
+
+        if self._session is not None:
+            self._session.close()
+
+        if self._cache is not None:
+            self._cache.close()
+
     def _get_urls(self) -> list[str]:
         """Get list of URLs from file."""
 
-        urls_file = self._config.get("urls_file", "urls.txt")
+        urls_file = self.urls_file
 
         logger.debug("Opening '%s'", urls_file)
 
         with open(urls_file, "r", encoding="utf-8") as f:
-            urls = [line.strip() for line in f.readlines()]
+            stripped = (line.strip() for line in f)
+
+            # skip blanks and comments
+            lines = [
+                self._normalize_line(line)
+                for line in stripped
+                if line and not line.startswith("#")
+            ]
 
-            f.close()
+        # dict keeps first occurrence order
+        urls = list(dict.fromkeys(lines))
 
-        logger.debug("urls = %s", urls)
+        if len(urls) < len(lines):
+            logger.debug("Dropped %d duplicate URLs.", len(lines) - len(urls))
 
         return urls
 
+    def _normalize_line(self, line: str) -> str:
+        """Normalize the URL in a line so equivalent URLs compare equal."""
+
+        prefix, separator, url = line.partition(self.folder_separator)
+
+        if not separator:
+            prefix, url = "", line
+
+        try:
+            parts = urllib.parse.urlsplit(url)
+        except ValueError:
+            # leave it as is; retrieving it will fail and be logged
+            return line
+
+        # scheme and host are case-insensitive; user info is not
+        user_info, at, host = parts.netloc.rpartition("@")
+
+        parts = parts._replace(
+            scheme=parts.scheme.lower(), netloc=f"{user_info}{at}{host.lower()}"
+        )
+
+        # "https://example.com" and "https://example.com/" are the same resource
+        if parts.netloc and not parts.path:
+            parts = parts._replace(path="/")
+
+        return f"{prefix}{separator}{parts.geturl()}"
+
     def _build_bookmarks_dict(self) -> dict:
         """Create nested dictionary of bookmarks by folder.
 
@@ -183,82 +460,79 @@ class Utils:
         }
         """
 
-        bookmarks_dict = {BOOKMARKS_KEY: [], FOLDERS_KEY: {}}
-
-        bookmarks = self._get_bookmarks_list()
-
-        for bookmark_info in bookmarks:
-            folders = bookmark_info.folders
-
-            logger.debug("folders = %s", folders)
-
-            bookmarks_list = bookmarks_dict[BOOKMARKS_KEY]
+        # local names avoid a global lookup per folder level
+        bookmarks_key = BOOKMARKS_KEY
+        folders_key = FOLDERS_KEY
 
-            d = bookmarks_dict[FOLDERS_KEY]
+        def new_folder() -> dict:
+            # missing subfolders are created on first access
+            return {bookmarks_key: [], folders_key: defaultdict(new_folder)}
 
-            for folder in folders:
-                logger.debug("folder = %s", folder)
+        bookmarks_dict = new_folder()
 
-                if folder not in d:
-                    logger.debug("Creating object for folder %s", folder)
-
-                    d[folder] = {BOOKMARKS_KEY: [], FOLDERS_KEY: {}}
-
-                bookmarks_list = d[folder][BOOKMARKS_KEY]
+        bookmarks = self._get_bookmarks_list()
 
-                logger.debug("bookmarks_list = %s", bookmarks_list)
+        for bookmark_info in bookmarks:
+            node = bookmarks_dict
 
-                d = d[folder][FOLDERS_KEY]
+            for folder in bookmark_info.folders:
+                node = node[folders_key][folder]
 
-            bookmarks_list.append(bookmark_info)
+            node[bookmarks_key].append(bookmark_info)
 
-        logger.debug("bookmarks_dict = %s", bookmarks_dict)
+        logger.debug("Arranged %d bookmarks into folders.", len(bookmarks))
 
         return bookmarks_dict
 
-    def _build_folder_bookmark_elements(self, folder: str, bookmarks_dict: dict):
-        """Build list of bookmarks for a folder from bookmarks_dict."""
+    def _write_bookmarks_dict(self, f, bookmarks_dict: dict, depth: int):
+        """Write folders and bookmarks from bookmarks_dict.
 
-        folder_element = dt()
+        Folders are walked depth-first with an explicit stack rather than
+        recursion. Each folder is pushed a second time as a closing entry so
+        its bookmarks and end tag are written after all of its subfolders.
+        """
 
-        folder_element.add(
-            H3(
-                folder,
-                ADD_DATE=current_time_seconds,
-                LAST_MODIFIED=current_time_seconds,
-            )
-        )
+        # local names avoid global and attribute lookups once per line
+        write = f.write
+        escape = html.escape
+        bookmarks_key = BOOKMARKS_KEY
+        folders_key = FOLDERS_KEY
+        date_attributes = DATE_ATTRIBUTES
 
-        _p = folder_element.add(dl()).add(p())
+        # (folder name, folder dict, depth, closing); the root has no name
+        stack = [(None, bookmarks_dict, depth - 1, False)]
+        pop = stack.pop
+        push = stack.append
 
-        # process sub-folders
-        for subfolder in bookmarks_dict[FOLDERS_KEY][folder][FOLDERS_KEY]:
-            _p.add(
-                self._build_folder_bookmark_elements(
-                    subfolder, bookmarks_dict[FOLDERS_KEY][folder]
-                )
-            )
+        while stack:
+            folder, folder_dict, level, closing = pop()
 
-        # write folder bookmarks
-        for bookmark in bookmarks_dict[FOLDERS_KEY][folder][BOOKMARKS_KEY]:
-            _p.add(bookmark.html())
+            indent = INDENT * level
 
-        return folder_element
+            if closing:
+                bookmark_indent = indent + INDENT
 
-    def _build_bookmark_elements(self, parent):
-        """Build list of bookmark lines to output."""
+                # write folder bookmarks
+                for bookmark in folder_dict[bookmarks_key]:
+                    write(f"{bookmark_indent}{bookmark.html()}\n")
 
-        bookmarks_dict = self._build_bookmarks_dict()
+                if folder is not None:
+                    write(f"{indent}</DL><p>\n")
 
-        for folder in bookmarks_dict[FOLDERS_KEY]:
-            logger.debug("folder = %s", folder)
+                continue
 
-            parent.add(self._build_folder_bookmark_elements(folder, bookmarks_dict))
+            if folder is not None:
+                # BUG in Chromium: <H3> tag must be uppercase to import properly
+                write(f"{indent}<DT><H3{date_attributes}>{escape(folder)}</H3>\n")
+                write(f"{indent}<DL><p>\n")
 
-        for bookmark in bookmarks_dict[BOOKMARKS_KEY]:
-            parent.add(bookmark.html())
+            push((folder, folder_dict, level, True))
 
-        return parent
+            # process sub-folders; reversed so they pop in insertion order
+            subfolders = folder_dict[folders_key]
+
+            for subfolder in reversed(subfolders):
+                push((subfolder, subfolders[subfolder], level + 1, False))
 
     def _get_bookmarks_list(self) -> list[BookmarkInfo]:
         """Get list of bookmarks."""
@@ -268,42 +542,41 @@ class Utils:
 
         logger.debug("Read %d URLs.", len(urls))
 
-        bookmarks = [self._get_bookmark_info(url) for url in urls]
+        # retrieval is I/O-bound, so overlap requests across worker threads;
+        # map() keeps results in the same order as the URLs file
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                bookmarks = list(executor.map(self._get_bookmark_info, urls))
+            except BaseException:
+                # e.g. Ctrl-C; don't fetch the URLs still queued before exiting
+                executor.shutdown(cancel_futures=True)
+
+                raise
 
-        if self._config.get("sort", False):
-            bookmarks.sort()
+        if self.sort_bookmarks:
+            # sort() computes each (folders, url) key once and compares them in C,
+            # instead of calling BookmarkInfo.__lt__ O(N log N) times
+            bookmarks.sort(key=operator.attrgetter("folders", "url"))
 
         return bookmarks
 
-    def _build_bookmarks_file(self):
-        _document = document(
-            title="Bookmarks", doctype="<!DOCTYPE NETSCAPE-Bookmark-file-1>"
+    def _write_bookmarks_file(self, f, bookmarks_dict: dict):
+        """Write bookmarks file in Netscape bookmark format."""
+
+        f.write(
+            "<!DOCTYPE NETSCAPE-Bookmark-file-1>\n"
+            '<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">\n'
+            "<TITLE>Bookmarks</TITLE>\n"
+            "<H1>Bookmarks</H1>\n"
+            "<DL><p>\n"
+            f'{INDENT}<DT><H3{DATE_ATTRIBUTES} PERSONAL_TOOLBAR_FOLDER="true">'
+            "Bookmarks</H3>\n"
+            f"{INDENT}<DL><p>\n"
         )
 
-        with _document.head:
-            # raw(
-            #     """<!-- This is an automatically generated file.
-            #             It will be read and overwritten.
-            #             DO NOT EDIT! -->"""
-            # )
-            meta(http_equiv="Content-Type", content="text/html; charset=UTF-8")
-
-        with _document:
-            h1("Bookmarks")
-
-            with dl().add(p()).add(dt()):
-                H3(
-                    "Bookmarks",
-                    ADD_DATE=current_time_seconds,
-                    LAST_MODIFIED=current_time_seconds,
-                    PERSONAL_TOOLBAR_FOLDER="true",
-                )
-
-                _p = dl().add(p())
-
-        self._build_bookmark_elements(_p)
+        self._write_bookmarks_dict(f, bookmarks_dict, 2)
 
-        return _document.render()
+        f.write(f"{INDENT}</DL><p>\n</DL><p>\n")
 
     def write_bookmarks(self):
         """Write bookmarks to an HTML file.
@@ -313,35 +586,64 @@ class Utils:
         <https://learn.microsoft.com/en-us/previous-versions/windows/internet-explorer/ie-developer/platform-apis/aa753582(v=vs.85)>`_.
         """
 
-        bookmarks_file = self._config.get("bookmarks_html_file", "bookmarks.html")
+        bookmarks_file = self.bookmarks_html_file
 
-        logger.debug("Writing '%s'", bookmarks_file)
+        # retrieve everything first so a failure leaves any existing file intact
+        bookmarks_dict = self._build_bookmarks_dict()
 
-        with open(bookmarks_file, "w", encoding="utf-8") as f:
-            f.write(self._build_bookmarks_file())
+        logger.debug("Writing '%s'", bookmarks_file)
 
-            f.close()
+        # write as we go rather than building the whole document in memory
+        with open(bookmarks_file, "w", encoding="utf-8", buffering=1 << 20) as f:
+            self._write_bookmarks_file(f, bookmarks_dict)
 
-    def _get_contents(self, url: str) -> requests.Response:
+    def _get_contents(
+        self, url: str, headers: dict = None, stream: bool = False
+    ) -> requests.Response:
         """Get binary contents of file from URL."""
 
-        with requests.Session() as s:
-            response = s.get(
-                url,
-                headers=self.default_headers,
-                timeout=self.request_timeout,
-            )
+        self._rate_limiter.wait(url)
 
-            logger.debug("response = %s", response.headers)
+        response = self._session.get(
+            url, headers=headers, stream=stream, timeout=self.request_timeout
+        )
+
+        logger.debug("response = %s", response.headers)
 
+        try:
             response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            response.close()
+
+            raise
 
         return response
 
-    def _get_html(self, url: str) -> BookmarkInfo:
+    def _read_head(self, response: requests.Response) -> bytes:
+        """Read response body only until the markup we parse has arrived."""
+
+        # the title is enough unless favicon links in <head> are needed too
+        end_re = HEAD_END_RE if self.read_favicon else TITLE_END_RE
+
+        content = bytearray()
+
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            # back up a few bytes in case the end tag straddles two chunks
+            start = max(len(content) - 8, 0)
+
+            content += chunk
+
+            if end_re.search(content, start) or len(content) >= self.max_bytes:
+                break
+
+        return bytes(content)
+
+    def _get_html(self, url: str, headers: dict = None) -> BookmarkInfo:
         """Get HTML for a given URL."""
 
-        response = self._get_contents(url)
+        # stream so large pages are not downloaded past the part we parse
+        with self._get_contents(url, headers, stream=True) as response:
+            content = self._read_head(response)
 
         # update response URL if redirected
         if url != response.url and self.rewrite_url:
@@ -349,20 +651,103 @@ class Utils:
 
             url = response.url
 
-        return BookmarkInfo(url, response.content)
+        bookmark_info = BookmarkInfo(url, content)
+
+        bookmark_info.response_url = response.url
+
+        # requests assumes ISO-8859-1 for text/* without a charset; ignore that guess
+        if "charset" in response.headers.get("Content-Type", "").lower():
+            bookmark_info.encoding = response.encoding
+        bookmark_info.etag = response.headers.get("ETag")
+        bookmark_info.last_modified = response.headers.get("Last-Modified")
+        bookmark_info.modified = response.status_code != requests.codes.not_modified
+
+        return bookmark_info
+
+    def _get_cached(self, url: str) -> sqlite3.Row:
+        """Get cached information for URL, or None."""
+
+        if self._cache is None:
+            return None
+
+        return self._cache.get(url)
+
+    def _is_complete(self, cached: sqlite3.Row) -> bool:
+        """Determine whether a cached row holds everything this run needs."""
+
+        # rows cached while favicons were disabled never looked for one
+        return cached is not None and (
+            not self.read_favicon or cached["favicon"] is not None
+        )
+
+    def _cached_favicon(self, cached: sqlite3.Row) -> str:
+        """Get the cached favicon, unless favicons have since been disabled."""
+
+        if not self.read_favicon or cached["favicon"] == NO_FAVICON:
+            return None
+
+        return cached["favicon"]
+
+    def _from_cache(self, url: str, cached: sqlite3.Row) -> BookmarkInfo:
+        """Get page info from a cached row."""
+
+        # the cached URL may have been rewritten before rewrite_url was turned off
+        if self.rewrite_url:
+            bookmark_info = BookmarkInfo(cached["resolved_url"], None)
+        else:
+            bookmark_info = BookmarkInfo(url, None)
+
+        bookmark_info.title = cached["title"]
+        bookmark_info.favicon = self._cached_favicon(cached)
+
+        return bookmark_info
+
+    def _fall_back(self, url: str, cached: sqlite3.Row) -> BookmarkInfo:
+        """Get page info when retrieval failed, from the cache if possible."""
+
+        if cached is not None:
+            # keep what an earlier run found; the stale row is retried next run
+            return self._from_cache(url, cached)
+
+        # use URL as title and keep going
+        bookmark_info = BookmarkInfo(url, None)
+
+        bookmark_info.title = url
+
+        return bookmark_info
+
+    def _get_validators(self, cached: sqlite3.Row) -> dict:
+        """Get conditional request headers so unchanged pages return 304."""
+
+        headers = {}
+
+        if cached is not None:
+            if cached["etag"] is not None:
+                headers["If-None-Match"] = cached["etag"]
+
+            if cached["last_modified"] is not None:
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        return headers
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _guess_mime_type(extension: str) -> str:
+        """Guess MIME type from a file extension such as ".ico"."""
+
+        return mimetypes.guess_type(f"favicon{extension}")[0]
 
     def _determine_mime_type(self, favicon_url: str) -> str:
         """Determine MIME type from URL."""
 
-        # try based on file name
-        mime_type = mimetypes.guess_type(favicon_url)
+        # try based on file name; few distinct extensions, so memoize by extension
+        path = urllib.parse.urlsplit(favicon_url).path
 
-        if len(mime_type) != 2:
-            mime_type = None
-        else:
-            mime_type = str(mime_type[0])
+        extension = posixpath.splitext(path)[1].lower()
+
+        mime_type = self._guess_mime_type(extension) if extension else None
 
-        return mime_type
+        return str(mime_type)
 
     def _use_this_favicon(self, icon) -> bool:
         """Determine whether to use this favicon or not."""
@@ -379,21 +764,66 @@ class Utils:
 
         return True
 
-    def _parse_favicon_data(self, soup: BeautifulSoup) -> str:
+    def _get_favicon_data(self, favicon_url: str, mime_type: str) -> str:
+        """Get favicon as a data URI, downloading each favicon once."""
+
+        # fragments never reach the server; the query may pick a different icon,
+        # and the MIME type is part of the data URI
+        key = (urllib.parse.urldefrag(favicon_url).url, mime_type)
+
+        return self._once(
+            self._favicons,
+            self._favicons_lock,
+            key,
+            functools.partial(self._download_favicon, favicon_url, mime_type),
+        )
+
+    def _download_favicon(self, favicon_url: str, mime_type: str) -> str:
+        """Download favicon and encode it as a data URI."""
+
+        favicon_contents = self._get_contents(favicon_url)
+
+        encoded_data = binascii.b2a_base64(
+            favicon_contents.content, newline=False
+        ).decode("ascii")
+
+        # data:<mime-type>;base64,<base64-encoded-data>
+        return f"data:{mime_type};base64,{encoded_data}"
+
+    def _parse_favicon_data(self, document: HtmlElement, page_url: str) -> str:
         """Get favicon data from links in page HTML."""
 
-        favicon_links = soup.find_all("link", rel="icon")
+        # rel is a space-separated list, e.g. "shortcut icon"
+        favicon_links = [
+            link
+            for link in document.iter("link")
+            if "icon" in link.get("rel", "").lower().split()
+        ]
 
         logger.debug("favicon_links = %s", favicon_links)
 
         favicon_data = None
 
-        if favicon_links is not None:
-            for icon in favicon_links:
-                if not self._use_this_favicon(icon):
-                    continue
+        for icon in favicon_links:
+            if not self._use_this_favicon(icon):
+                continue
+
+            favicon_url = icon.get("href")
+
+            if not favicon_url:
+                continue
+
+            # inline icons are already data URIs; no request needed
+            if favicon_url.startswith("data:"):
+                favicon_data = favicon_url
+
+                break
+
+            # hrefs come from remote pages, so malformed URLs raise ValueError
+            try:
+                # resolve relative links such as "/favicon.ico" against the page
+                favicon_url = urllib.parse.urljoin(page_url, favicon_url)
 
-                favicon_url = icon.get("href")
                 favicon_type = icon.get("type")
 
                 if favicon_type is not None:
@@ -403,104 +833,258 @@ class Utils:
 
                 logger.debug("mime_type = %s", mime_type)
 
-                favicon_contents = self._get_contents(favicon_url)
-
-                if favicon_contents is not None:
-                    encoded_bytes = base64.b64encode(favicon_contents.content)
+                favicon_data = self._get_favicon_data(favicon_url, mime_type)
+            except (requests.exceptions.RequestException, ValueError) as ex:
+                # a missing favicon shouldn't cost the page its title
+                logger.error("Error retrieving favicon: %s", ex)
 
-                    encoded_data = encoded_bytes.decode("utf-8")
+                continue
 
-                    # data:<mime-type>;base64,<base64-encoded-data>
-                    favicon_data = f"data:{mime_type};base64,{encoded_data}"
-
-                # stop loop once we processed one; TODO: refactor this!
-                break
+            # stop loop once we processed one; TODO: refactor this!
+            break
 
         return favicon_data
 
-    def _parse_title(self, soup: BeautifulSoup, url: str) -> str:
+    def _parse_title(self, document: HtmlElement, url: str) -> str:
         """Parse title information from HTML."""
 
-        title = soup.select_one("title")
+        title = document.findtext(".//title")
 
-        if title is not None and title.string is not None:
-            title = title.string.strip()
+        if title:
+            title = title.strip()
 
             logger.debug("title = %s", title)
-        else:
+
+        if not title:
             title = url
 
         return str(title)
 
+    def _head_of(self, content: bytes) -> bytes:
+        """Trim HTML to its <head>, which holds the title and favicon links."""
+
+        match = HEAD_END_RE.search(content)
+
+        if match is not None:
+            content = content[: match.start()]
+
+        return content
+
+    def _declared_encoding(self, content: bytes, encoding: str) -> str:
+        """Get the header charset, else the page's <meta charset>, else None."""
+
+        # fall back to the page's own declaration when the header had none
+        if encoding is None:
+            meta_charset = META_CHARSET_RE.search(content, 0, META_CHARSET_BYTES)
+
+            if meta_charset is not None:
+                encoding = meta_charset.group(1).decode("ascii")
+
+        return encoding
+
+    def _decode(self, raw: bytes, encoding: str) -> str:
+        """Decode bytes using the declared encoding, else UTF-8 or Windows-1252."""
+
+        if encoding is not None:
+            try:
+                return raw.decode(encoding, "replace")
+            except LookupError:
+                logger.debug("Unknown encoding '%s'", encoding)
+
+        try:
+            return raw.decode("utf-8")
+        except UnicodeDecodeError:
+            # legacy pages are most often Windows-1252
+            return raw.decode("cp1252", "replace")
+
+    def _match_title(self, content: bytes, url: str, encoding: str = None) -> str:
+        """Match title in raw HTML without building a document tree."""
+
+        match = TITLE_RE.search(content)
+
+        title = None
+
+        if match is not None:
+            encoding = self._declared_encoding(content, encoding)
+
+            title = self._decode(match.group(1), encoding)
+
+            title = html.unescape(title).strip()
+
+            logger.debug("title = %s", title)
+
+        return title or url
+
     def _get_folders(self, line: str) -> tuple[list[str], str]:
         """Parse folders and URL from line."""
 
         folders = []
         url = line
 
-        # split on folder_separator
-        items = line.split(self.folder_separator)
+        # only the first folder_separator matters, so avoid splitting the whole line
+        prefix, separator, rest = line.partition(self.folder_separator)
 
-        if len(items) > 1:
+        if separator:
             # sub-split on subfolder_separator
-            folders = str(items[0]).split(self.subfolder_separator)
+            folders = prefix.split(self.subfolder_separator)
 
-            url = items[1]
+            url = rest
 
         logger.debug("folders('%s') = %s", url, folders)
 
         return folders, url
 
     def _get_bookmark_info(self, line: str) -> BookmarkInfo:
-        """Get bookmark info from HTML."""
+        """Get bookmark info for a line from the URLs file."""
 
         logger.debug("Retrieving info for '%s'.", line)
 
-        bookmark_info = None
-        favicon_data = None
-
         folders, url = self._get_folders(line)
 
         try:
-            bookmark_info = self._get_html(url)
+            page_info = self._get_page_info(url)
+        except Exception:
+            # one page failing unexpectedly shouldn't discard the whole run
+            logger.exception("Error retrieving info for '%s'.", url)
+
+            page_info = BookmarkInfo(url, None)
+
+            page_info.title = url
+
+        bookmark_info = BookmarkInfo(page_info.url, None)
+
+        bookmark_info.title = page_info.title
+        bookmark_info.favicon = page_info.favicon
+        bookmark_info.folders = folders
+
+        return bookmark_info
+
+    def _get_page_info(self, url: str) -> BookmarkInfo:
+        """Get page info for URL, retrieving each URL once per run."""
+
+        return self._once(
+            self._pages,
+            self._pages_lock,
+            url,
+            functools.partial(self._retrieve_page_info, url),
+        )
+
+    @staticmethod
+    def _once(memo: dict, lock: threading.Lock, key, fn):
+        """Call fn once per key in memo; concurrent callers share its result."""
+
+        with lock:
+            future = memo.get(key)
+
+            first = future is None
+
+            if first:
+                future = memo[key] = Future()
+
+        # the first caller runs fn; concurrent callers wait for its result
+        if first:
+            try:
+                future.set_result(fn())
+            except Exception as ex:
+                # waiters would otherwise block forever
+                future.set_exception(ex)
+
+                raise
 
-            soup = BeautifulSoup(bookmark_info.content, "html.parser")
+        return future.result()
 
-            title = self._parse_title(soup, url)
+    def _retrieve_page_info(self, url: str) -> BookmarkInfo:
+        """Get page info from the cache or from HTML."""
 
-            if self.read_favicon:
-                favicon_data = self._parse_favicon_data(soup)
-        except requests.exceptions.RequestException as ex:
+        cached = self._get_cached(url)
+
+        complete = self._is_complete(cached)
+
+        if complete and time.time() - cached["fetched"] < self.cache_ttl:
+            logger.debug("Using cached info for '%s'.", url)
+
+            return self._from_cache(url, cached)
+
+        # an incomplete row must be fetched in full, so send no validators
+        validators = self._get_validators(cached if complete else None)
+
+        try:
+            bookmark_info = self._get_html(url, validators)
+        except (requests.exceptions.RequestException, ValueError) as ex:
+            # ValueError comes from malformed URLs, e.g. "http://[bad"
             logger.error("Error retrieving HTML: %s", ex)
 
-            # use URL as title and keep going
-            if bookmark_info is None:
-                bookmark_info = BookmarkInfo(url, "")
+            return self._fall_back(url, cached)
 
-            title = url
-        except ImportError as ex:
-            logger.error("Error parsing HTML: %s", ex)
+        if not bookmark_info.modified and not complete:
+            logger.error("'%s' not modified, but nothing usable is cached.", url)
 
-            if bookmark_info is None:
-                bookmark_info = BookmarkInfo(url, "")
+            # treat it like other failed responses
+            return self._fall_back(url, cached)
 
-            title = url
+        if not bookmark_info.modified:
+            logger.debug("'%s' not modified; using cached info.", url)
 
-        bookmark_info.title = title
-        bookmark_info.favicon = favicon_data
-        bookmark_info.folders = folders
+            bookmark_info.title = cached["title"]
+            bookmark_info.favicon = self._cached_favicon(cached)
+
+            # a 304 need not repeat the validators
+            bookmark_info.etag = bookmark_info.etag or cached["etag"]
+            bookmark_info.last_modified = (
+                bookmark_info.last_modified or cached["last_modified"]
+            )
+        else:
+            bookmark_info.title, bookmark_info.favicon = self._extract_page_info(
+                bookmark_info, url
+            )
+
+        # the HTML has been parsed; don't keep it until the file is written
+        bookmark_info.content = None
 
-        self._sleep()
+        if self._cache is not None:
+            self._cache.put(url, bookmark_info, self.read_favicon)
 
         return bookmark_info
 
-    def _sleep(self):
-        """Sleep for configured number of milliseconds."""
+    def _extract_page_info(
+        self, bookmark_info: BookmarkInfo, url: str
+    ) -> tuple[str, str]:
+        """Extract title and favicon data from retrieved HTML."""
 
-        if self._sleep_duration > 0:
-            if self.random_sleep:
-                sleep_multiplier = random.random()
-            else:
-                sleep_multiplier = float(1)
+        if not self.read_favicon:
+            # only the title is needed, so skip parsing the whole page
+            title = self._match_title(
+                bookmark_info.content, url, bookmark_info.encoding
+            )
+
+            return title, None
+
+        document = self._parse_head(bookmark_info.content, bookmark_info.encoding)
+
+        if document is None:
+            return url, None
+
+        title = self._parse_title(document, url)
+
+        favicon_data = self._parse_favicon_data(document, bookmark_info.response_url)
+
+        return title, favicon_data
+
+    def _parse_head(self, content: bytes, encoding: str = None) -> HtmlElement:
+        """Parse the <head> of HTML, or None if there is nothing to parse."""
+
+        head = self._head_of(content)
+
+        # decode as the title regex does, rather than leaving it to lxml's guess
+        text = self._decode(head, self._declared_encoding(head, encoding))
+
+        # lxml rejects str input that still carries an encoding declaration
+        text = XML_DECLARATION_RE.sub("", text, count=1)
+
+        try:
+            return document_fromstring(text)
+        except ParserError as ex:
+            # raised for empty documents
+            logger.error("Error parsing HTML: %s", ex)
 
-            time.sleep((self._sleep_duration / 1000) * sleep_multiplier)
+            return None